@@ -1,17 +1,26 @@
-from fastapi import FastAPI, UploadFile, File
+from fastapi import FastAPI, UploadFile, File, Request, Response
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
 from dotenv import load_dotenv
 from pathlib import Path
+from typing import Dict, List, Optional
 
 # Import the new RAG system (optional)
 try:
     from rag_pipeline import create_rag_system
+    from rag_replay import QueryRecorder
     RAG_AVAILABLE = True
 except ImportError as e:
     print(f"Warning: RAG pipeline not available: {e}")
     create_rag_system = None
+    QueryRecorder = None
     RAG_AVAILABLE = False
 
 # Load environment variables from root .env file
@@ -44,8 +53,16 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize RAG system (will be created on first use)
+# Compress large JSON bodies (sources lists, schedules); small probes are left as-is
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+
+# RAG system, built in a worker thread by the startup health refresh (or by the
+# first request that needs it, if that comes sooner)
 rag_system = None
+rag_system_lock = threading.Lock()
+
+# Record queries for offline replay (see rag_replay.py) when RAG_RECORD_PATH is set
+query_recorder = QueryRecorder(os.getenv("RAG_RECORD_PATH")) if RAG_AVAILABLE and os.getenv("RAG_RECORD_PATH") else None
 
 def get_rag_system():
     """Lazy initialization of RAG system to handle startup errors gracefully."""
@@ -53,22 +70,204 @@ def get_rag_system():
     if not RAG_AVAILABLE:
         return None
         
-    if rag_system is None:
+    if rag_system is not None:
+        return rag_system
+    
+    # The health refresher initializes from a worker thread; build only once
+    with rag_system_lock:
+        if rag_system is not None:
+            return rag_system
         try:
             rag_system = create_rag_system(
                 pinecone_api_key=os.getenv("PINECONE_API_KEY"),
                 pinecone_index_name=os.getenv("PINECONE_INDEX_NAME", "openaicourses"),
                 llm_provider=os.getenv("LLM_PROVIDER", "openai"),
-                llm_model=os.getenv("LLM_MODEL", "gpt-4o-mini-2024-07-18")
+                llm_model=os.getenv("LLM_MODEL", "gpt-4o-mini-2024-07-18"),
+                enable_query_decomposition=os.getenv("RAG_QUERY_DECOMPOSITION", "false").lower() == "true"
             )
         except Exception as e:
             print(f"Error initializing RAG system: {e}")
             return None
     return rag_system
 
+async def get_rag_system_async():
+    """Return the RAG system, running any pending initialization off the event loop."""
+    if rag_system is not None:
+        return rag_system
+    return await asyncio.to_thread(get_rag_system)
+
+def json_response(request: Request, payload: dict, max_age: int = 0) -> Response:
+    """
+    Serialize a deterministic payload with an ETag and Cache-Control header.
+    
+    Returns 304 Not Modified when the client's If-None-Match matches.
+    """
+    body = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={max_age}" if max_age else "no-cache"
+    }
+    
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+# Health snapshot, refreshed in the background so probes never touch the RAG system
+HEALTH_TTL_SECONDS = int(os.getenv("HEALTH_TTL_SECONDS", "30"))
+health_snapshot = None
+health_refresh_task = None
+
+def build_health_status() -> dict:
+    """Build the detailed health report for all components."""
+    health_status = {
+        "api": "healthy",
+        "rag_system": "unknown",
+        "environment": {}
+    }
+    
+    # Check environment variables
+    required_env_vars = ["OPENAI_API_KEY", "PINECONE_API_KEY"]
+    for var in required_env_vars:
+        health_status["environment"][var] = "set" if os.getenv(var) else "missing"
+    
+    # Test RAG system
+    try:
+        rag = get_rag_system()
+        health_status["rag_system"] = "healthy" if rag else "failed"
+    except Exception as e:
+        health_status["rag_system"] = f"error: {str(e)}"
+    
+    return health_status
+
+async def refresh_health_snapshot():
+    """Rebuild the health snapshot off the event loop."""
+    global health_snapshot
+    health_snapshot = await asyncio.to_thread(build_health_status)
+
+async def health_refresh_loop():
+    """Keep the health snapshot fresh for the lifetime of the server."""
+    while True:
+        try:
+            await refresh_health_snapshot()
+        except Exception as e:
+            print(f"Error refreshing health snapshot: {e}")
+        await asyncio.sleep(HEALTH_TTL_SECONDS)
+
+@app.on_event("startup")
+async def start_health_refresh():
+    global health_refresh_task
+    # Keep a reference; the event loop only holds tasks weakly
+    health_refresh_task = asyncio.create_task(health_refresh_loop())
+
+
+class StudentProfile(BaseModel):
+    completed_courses: List[str] = []
+    in_progress_courses: List[str] = []
+    major: Optional[str] = None
+
 class ChatRequest(BaseModel):
     message: str
     thread_id: str
+    student_profile: Optional[StudentProfile] = None
+
+
+class PrefetchRequest(BaseModel):
+    message: str
+    thread_id: str
+
+
+# Student profiles keyed by thread_id; a profile sent once applies to later
+# messages in the same session. Shared thread ids (such as the client's
+# "default-thread") are never persisted, so one student's profile cannot leak
+# into another student's retrieval.
+STUDENT_PROFILE_TTL_SECONDS = int(os.getenv("STUDENT_PROFILE_TTL_SECONDS", "3600"))
+SHARED_THREAD_IDS = {"", "default-thread"}
+student_profiles: Dict[str, dict] = {}
+
+def store_student_profile(thread_id: str, profile: StudentProfile):
+    """Remember a profile for a per-session thread, sweeping expired entries."""
+    if thread_id in SHARED_THREAD_IDS:
+        return
+    
+    now = time.monotonic()
+    for expired in [t for t, e in student_profiles.items() if now - e["updated"] > STUDENT_PROFILE_TTL_SECONDS]:
+        student_profiles.pop(expired, None)
+    
+    student_profiles[thread_id] = {"profile": profile, "updated": now}
+
+def get_student_profile(thread_id: str) -> Optional[StudentProfile]:
+    """Return the stored profile for a thread if it has not expired."""
+    entry = student_profiles.get(thread_id)
+    if entry is None:
+        return None
+    
+    now = time.monotonic()
+    if now - entry["updated"] > STUDENT_PROFILE_TTL_SECONDS:
+        student_profiles.pop(thread_id, None)
+        return None
+    
+    entry["updated"] = now
+    return entry["profile"]
+
+
+# Speculative retrieval slots keyed by thread_id, filled by /chat/prefetch
+PREFETCH_TTL_SECONDS = int(os.getenv("PREFETCH_TTL_SECONDS", "30"))
+PREFETCH_MAX_CONCURRENT = int(os.getenv("PREFETCH_MAX_CONCURRENT", "8"))
+PREFETCH_MIN_CHARS = 8
+prefetch_slots: Dict[str, dict] = {}
+active_prefetches = 0
+
+def normalize_message(message: str) -> str:
+    """Normalize a message so prefetched and final queries can be compared."""
+    return " ".join(message.lower().split())
+
+def discard_prefetch(thread_id: str):
+    """Drop and cancel the prefetch parked for a thread, if any."""
+    slot = prefetch_slots.pop(thread_id, None)
+    if slot is not None and not slot["task"].done():
+        slot["task"].cancel()
+
+def prefetch_finished(task: asyncio.Task):
+    """Release a prefetch's share of the global cap, even if it was cancelled."""
+    global active_prefetches
+    active_prefetches -= 1
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Prefetch failed: {task.exception()}")
+
+async def take_prefetched_documents(thread_id: str, message: str, student_profile: Optional[dict]):
+    """
+    Return documents prefetched for this exact message and profile, or None.
+    
+    A prefetch that is still running is awaited, since it has already
+    started the same retrieval the request would otherwise repeat.
+    """
+    slot = prefetch_slots.pop(thread_id, None)
+    if slot is None:
+        return None
+    
+    stale = time.monotonic() - slot["created"] > PREFETCH_TTL_SECONDS
+    if slot["query"] != normalize_message(message) or slot["profile"] != student_profile or stale:
+        if not slot["task"].done():
+            slot["task"].cancel()
+        return None
+    
+    task = slot["task"]
+    try:
+        # Shield so cancelling this request does not look like a cancelled prefetch
+        documents = await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if task.cancelled():
+            return None
+        raise
+    except Exception as e:
+        print(f"Prefetch failed, retrieving again: {e}")
+        return None
+    
+    # Retrieval errors surface as an empty result; treat them as a miss and retry
+    return documents or None
 
 
 # Dummy schedule data
@@ -84,6 +283,15 @@ DUMMY_SCHEDULE = {
     "FA27": ["ANTH 101", "PHIL 180", "MUS 4"]
 }
 
+# The schedule reply never changes, so serialize it once at import time
+SCHEDULE_RESPONSE_BODY = json.dumps({
+    "messages": [{
+        "type": "ai",
+        "content": "Here's a recommended course schedule for your data science major:",
+        "schedule": DUMMY_SCHEDULE
+    }]
+}).encode("utf-8")
+
 
 @app.post("/chat")
 async def chat(request: ChatRequest):
@@ -93,21 +301,26 @@ async def chat(request: ChatRequest):
     Special commands:
     - "schedule": Returns dummy schedule data
     - Other queries: Processed through RAG pipeline
+    
+    An optional student_profile is used to skip completed courses during
+    retrieval. It is also remembered for later messages when thread_id is
+    per-session (not a shared id like "default-thread").
     """
     
+    profile = request.student_profile
+    if profile is not None:
+        store_student_profile(request.thread_id, profile)
+    else:
+        profile = get_student_profile(request.thread_id)
+    profile_dict = profile.model_dump() if profile else None
+    
     # Handle special schedule command
     if request.message.lower().strip() == "schedule":
-        return {
-            "messages": [{
-                "type": "ai",
-                "content": "Here's a recommended course schedule for your data science major:",
-                "schedule": DUMMY_SCHEDULE
-            }]
-        }
+        return Response(content=SCHEDULE_RESPONSE_BODY, media_type="application/json")
     
     # Process query through RAG pipeline
     try:
-        rag = get_rag_system()
+        rag = await get_rag_system_async()
         if rag is None:
             return {
                 "messages": [{
@@ -116,7 +329,23 @@ async def chat(request: ChatRequest):
                 }]
             }
         
-        result = await rag.query(request.message)
+        documents = await take_prefetched_documents(request.thread_id, request.message, profile_dict)
+        result = await rag.query(
+            request.message,
+            student_profile=profile_dict,
+            documents=documents
+        )
+        
+        if query_recorder is not None:
+            try:
+                await asyncio.to_thread(
+                    query_recorder.record,
+                    request.message,
+                    result,
+                    profile_dict
+                )
+            except Exception as e:
+                print(f"Error recording query: {e}")
         
         # Format response
         response_content = result["answer"]
@@ -135,6 +364,7 @@ async def chat(request: ChatRequest):
                 "type": "ai",
                 "content": response_content,
                 "sources": result.get("sources", []),
+                "usage": result.get("usage", {}),
                 "processing_time": result.get("processing_time", 0)
             }]
         }
@@ -151,6 +381,50 @@ async def chat(request: ChatRequest):
         }
 
 
+@app.post("/chat/prefetch")
+async def chat_prefetch(request: PrefetchRequest):
+    """
+    Speculatively run retrieval for partial input while the user types.
+    
+    Results are parked per thread_id for PREFETCH_TTL_SECONDS and reused by
+    /chat when the final message matches. Shared thread ids are skipped. A newer prefetch for the same
+    thread cancels the previous one; requests beyond PREFETCH_MAX_CONCURRENT
+    are skipped rather than queued.
+    """
+    global active_prefetches
+    
+    message = normalize_message(request.message)
+    if request.thread_id in SHARED_THREAD_IDS or len(message) < PREFETCH_MIN_CHARS or message == "schedule":
+        return {"status": "skipped"}
+    
+    slot = prefetch_slots.get(request.thread_id)
+    if slot is not None and slot["query"] == message:
+        return {"status": "pending" if not slot["task"].done() else "ready"}
+    discard_prefetch(request.thread_id)
+    
+    # Sweep expired slots from abandoned threads
+    now = time.monotonic()
+    for thread_id in [t for t, s in prefetch_slots.items() if now - s["created"] > PREFETCH_TTL_SECONDS]:
+        discard_prefetch(thread_id)
+    
+    if active_prefetches >= PREFETCH_MAX_CONCURRENT:
+        return {"status": "skipped"}
+    
+    # Speculative work never waits on initialization
+    rag = rag_system
+    if rag is None:
+        return {"status": "skipped"}
+    
+    profile = get_student_profile(request.thread_id)
+    profile_dict = profile.model_dump() if profile else None
+    active_prefetches += 1
+    task = asyncio.create_task(rag.retrieve(request.message, student_profile=profile_dict))
+    task.add_done_callback(prefetch_finished)
+    prefetch_slots[request.thread_id] = {"query": message, "profile": profile_dict, "task": task, "created": now}
+    
+    return {"status": "scheduled"}
+
+
 @app.post("/upload-degree-audit")
 async def upload_degree_audit(pdf: UploadFile = File(...)):
     """Upload and parse degree audit PDF."""
@@ -168,14 +442,14 @@ async def upload_degree_audit(pdf: UploadFile = File(...)):
 
 @app.head("/")
 @app.get("/")
-async def root():
+async def root(request: Request):
     """Health check endpoint with HEAD support for load balancers."""
-    return {
+    return json_response(request, {
         "message": "UCSD Course Advisory API", 
         "status": "running",
         "timestamp": os.getenv('RENDER_SERVICE_VERSION', 'dev'),
         "service": "fastapi-backend"
-    }
+    }, max_age=60)
 
 @app.head("/health")
 async def health_head():
@@ -183,25 +457,14 @@ async def health_head():
     return {"status": "OK"}  # GET would include full health_status
 
 @app.get("/health")
-async def health_check():
-    """Detailed health check for all components."""
-    health_status = {
-        "api": "healthy",
-        "rag_system": "unknown",
-        "environment": {}
-    }
-    
-    # Check environment variables
-    required_env_vars = ["OPENAI_API_KEY", "PINECONE_API_KEY"]
-    for var in required_env_vars:
-        health_status["environment"][var] = "set" if os.getenv(var) else "missing"
-    
-    # Test RAG system
-    try:
-        rag = get_rag_system()
-        health_status["rag_system"] = "healthy" if rag else "failed"
-    except Exception as e:
-        health_status["rag_system"] = f"error: {str(e)}"
-    
-    return health_status
+async def health_check(request: Request):
+    """Detailed health check for all components, served from a cached snapshot."""
+    if health_snapshot is None:
+        # Background refresher has not finished its first run yet
+        return json_response(request, {
+            "api": "healthy",
+            "rag_system": "starting",
+            "environment": {}
+        })
     
+    return json_response(request, health_snapshot)
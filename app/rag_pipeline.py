@@ -1,6 +1,7 @@
 
 
 import os
+import re
 import asyncio
 from typing import List, Dict, Any, Optional, Tuple
 from dataclasses import dataclass
@@ -10,7 +11,7 @@ from datetime import datetime
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain_anthropic import ChatAnthropic
 from langchain_pinecone import PineconeVectorStore
-from langchain.schema import Document
+from langchain.schema import Document, SystemMessage
 from langchain.prompts import ChatPromptTemplate
 
 # Pinecone imports
@@ -27,6 +28,42 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 
+COURSE_CODE_PATTERN = re.compile(r"\b([A-Z]{2,5})\s*(\d{1,3}[A-Z]{0,2})\b")
+
+
+def normalize_course_id(course_id: str) -> str:
+    """Normalize a course code for comparison (e.g. "dsc 100" -> "DSC100")."""
+    return re.sub(r"\s+", "", course_id.upper())
+
+
+def parse_prerequisites(prerequisites: str) -> List[List[str]]:
+    """
+    Parse prerequisite text into groups of alternative course codes.
+    
+    Clauses joined by "and" or ";" are all required; within a clause that
+    says "or" / "one of", any listed course satisfies it. For example
+    "DSC 40A and (MATH 18 or MATH 31AH)" -> [["DSC40A"], ["MATH18", "MATH31AH"]].
+    Case is preserved so prose like "one of 2 courses" is not read as a code.
+    
+    Args:
+        prerequisites: Raw prerequisite text from course metadata
+        
+    Returns:
+        List of groups, each satisfied by any one of its codes
+        (empty if no course codes were found)
+    """
+    groups = []
+    for clause in re.split(r";|\band\b", prerequisites, flags=re.IGNORECASE):
+        codes = [dept + num for dept, num in COURSE_CODE_PATTERN.findall(clause)]
+        if not codes:
+            continue
+        if re.search(r"\bor\b|\bone of\b", clause, flags=re.IGNORECASE):
+            groups.append(codes)
+        else:
+            groups.extend([code] for code in codes)
+    return groups
+
+
 @dataclass
 class RAGConfig:
     """Configuration for the RAG pipeline."""
@@ -43,9 +80,17 @@ class RAGConfig:
     
     # Retrieval settings
     top_k: int = 10
-    similarity_threshold: float = 0.5
+    similarity_threshold: float = 0.5  # not applied in retrieval yet
+    
+    # Query decomposition settings
+    enable_query_decomposition: bool = False
+    max_sub_queries: int = 3
+    sub_query_top_k: Optional[int] = None  # defaults to top_k // number of sub-queries
+    
+    # Prompt caching (Anthropic needs explicit cache_control; OpenAI caches prefixes automatically)
+    enable_prompt_caching: bool = True
     
-    # System prompt
+    # System prompt (static, so providers can cache it as a prompt prefix)
     system_prompt: str = """You are an expert academic advisor for UC San Diego specializing in course planning and degree requirements.
 
 Your role is to help students with:
@@ -67,9 +112,10 @@ For professors, do not provide links
 
 Do not use inline lists or numbered lists unless explicitly asked. Prioritize clarity and clean formatting using `•` style bullets.
 
-Be specific, helpful, and concise in your responses, only answer what the student asks. Always cite specific course codes when relevant. 
-
-Context Information:
+Be specific, helpful, and concise in your responses, only answer what the student asks. Always cite specific course codes when relevant."""
+    
+    # Per-request message, sent after the cacheable system prompt
+    question_prompt: str = """Context Information:
 {context}
 
 Student Question: {question}"""
@@ -86,18 +132,33 @@ class PineconeRAG:
     4. LLM response generation
     """
     
-    def __init__(self, config: RAGConfig):
-        """Initialize the RAG system with configuration."""
+    def __init__(
+        self,
+        config: RAGConfig,
+        embeddings: Optional[Any] = None,
+        vector_store: Optional[Any] = None,
+        llm: Optional[Any] = None
+    ):
+        """
+        Initialize the RAG system with configuration.
+        
+        Pre-built embeddings, vector_store or llm backends may be passed in
+        (e.g. recorded backends for offline replay); missing ones are created
+        from the config.
+        """
         self.config = config
-        self.embeddings = None
-        self.vector_store = None
-        self.llm = None
+        self.embeddings = embeddings
+        self.vector_store = vector_store
+        self.llm = llm
         self.prompt_template = None
         
         # Initialize components
-        self._setup_embeddings()
-        self._setup_vector_store()
-        self._setup_llm()
+        if self.embeddings is None and self.vector_store is None:
+            self._setup_embeddings()
+        if self.vector_store is None:
+            self._setup_vector_store()
+        if self.llm is None:
+            self._setup_llm()
         self._setup_prompt()
         
         logger.info("RAG pipeline initialized successfully")
@@ -152,13 +213,31 @@ class PineconeRAG:
             logger.error(f"Failed to initialize LLM: {e}")
             raise
     
+    def supports_prompt_caching(self) -> bool:
+        """Whether the provider needs explicit cache markers on the prompt prefix."""
+        return self.config.enable_prompt_caching and self.config.llm_provider.lower() == "anthropic"
+    
     def _setup_prompt(self):
-        """Initialize the prompt template."""
+        """
+        Initialize the prompt template.
+        
+        The system message holds only the fixed advisor instructions and is
+        built once, so every request shares an identical cacheable prefix.
+        Retrieved context and the question go in the human message.
+        """
+        if self.supports_prompt_caching():
+            self.system_message = SystemMessage(content=[{
+                "type": "text",
+                "text": self.config.system_prompt,
+                "cache_control": {"type": "ephemeral"}
+            }])
+        else:
+            self.system_message = SystemMessage(content=self.config.system_prompt)
+        
         self.prompt_template = ChatPromptTemplate.from_messages([
-            ("system", self.config.system_prompt),
-            ("human", "{question}")
+            ("human", self.config.question_prompt)
         ])
-        logger.info("Prompt template initialized")
+        logger.info(f"Prompt template initialized (explicit prompt caching: {self.supports_prompt_caching()})")
     
     async def embed_query(self, query: str) -> List[float]:
         """
@@ -221,6 +300,222 @@ class PineconeRAG:
             logger.error(f"Failed to retrieve documents: {e}")
             return []
     
+    def build_student_filter(
+        self,
+        student_profile: Optional[Dict[str, Any]],
+        filter_dict: Optional[Dict[str, Any]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Extend Pinecone filters to exclude courses the student has completed.
+        
+        Args:
+            student_profile: Optional profile with completed_courses
+            filter_dict: Existing Pinecone filters
+            
+        Returns:
+            Combined filter, or the original filter if there is nothing to exclude
+        """
+        completed = (student_profile or {}).get("completed_courses") or []
+        if not completed:
+            return filter_dict
+        
+        # Match both "DSC 100" and "DSC100" spellings of stored course ids
+        excluded = set()
+        for course_id in completed:
+            match = COURSE_CODE_PATTERN.search(course_id.upper())
+            if match:
+                excluded.add(f"{match.group(1)} {match.group(2)}")
+                excluded.add(f"{match.group(1)}{match.group(2)}")
+            else:
+                excluded.add(course_id.strip())
+        
+        exclusion = {"course_id": {"$nin": sorted(excluded)}}
+        if filter_dict:
+            return {"$and": [filter_dict, exclusion]}
+        return exclusion
+    
+    def apply_student_profile(
+        self,
+        documents: List[Document],
+        student_profile: Optional[Dict[str, Any]]
+    ) -> List[Document]:
+        """
+        Drop completed courses and rank courses the student is eligible for first.
+        
+        A course counts as eligible when its prerequisites parse into course
+        codes and every required group has a completed or in-progress course.
+        Courses with no parseable prerequisites keep their original rank.
+        
+        Args:
+            documents: Retrieved documents
+            student_profile: Optional profile with completed/in-progress courses
+            
+        Returns:
+            Filtered and reordered documents
+        """
+        if not student_profile:
+            return documents
+        
+        completed = {normalize_course_id(c) for c in student_profile.get("completed_courses") or []}
+        taken = completed | {normalize_course_id(c) for c in student_profile.get("in_progress_courses") or []}
+        
+        eligible = []
+        remaining = []
+        for doc in documents:
+            course_id = normalize_course_id(doc.metadata.get('course_id', ''))
+            if course_id in completed:
+                continue
+            
+            groups = parse_prerequisites(str(doc.metadata.get('prerequisites') or ''))
+            if groups and all(any(code in taken for code in group) for group in groups):
+                eligible.append(doc)
+            else:
+                remaining.append(doc)
+        
+        dropped = len(documents) - len(eligible) - len(remaining)
+        logger.info(f"Student profile applied: {dropped} completed dropped, {len(eligible)} eligible boosted")
+        return eligible + remaining
+    
+    def format_student_context(self, student_profile: Optional[Dict[str, Any]]) -> str:
+        """Summarize the student profile in a single short context line."""
+        if not student_profile:
+            return ""
+        
+        parts = []
+        if student_profile.get("major"):
+            parts.append(f"Major: {student_profile['major']}")
+        if student_profile.get("completed_courses"):
+            parts.append("Completed: " + ", ".join(student_profile["completed_courses"]))
+        if student_profile.get("in_progress_courses"):
+            parts.append("In progress: " + ", ".join(student_profile["in_progress_courses"]))
+        
+        if not parts:
+            return ""
+        return "Student Profile - " + "; ".join(parts)
+    
+    def decompose_query(self, query: str) -> List[str]:
+        """
+        Split a compound question into independent sub-queries.
+        
+        Splits on sentence boundaries and on "and"/"also" joins that start a
+        new question (e.g. "..., and which are offered in Fall?"). Sub-queries
+        that are too short to stand alone are folded back into the previous one,
+        and parts past max_sub_queries are merged into the last sub-query rather
+        than dropped. Follow-ups with no subject of their own ("which are
+        offered in Fall", "who teaches it") borrow the course codes of the
+        nearest earlier part, or the topic of the leading clause if none name a
+        course ("math courses" in "What math courses do I need...").
+        
+        Args:
+            query: User's question
+            
+        Returns:
+            List of sub-queries (the original query if it cannot be split)
+        """
+        parts = re.split(r"[?;]+\s*|\s*,?\s+(?:and|also)\s+(?=(?:what|which|when|where|who|how|is|are|do|does|can|should)\b)",
+                         query.strip(), flags=re.IGNORECASE)
+        
+        sub_queries = []
+        for part in parts:
+            part = re.sub(r"^(?:and|also|but|or)\s+(?:also\s+)?", "", part.strip(" ,."), flags=re.IGNORECASE)
+            if not part:
+                continue
+            if sub_queries and len(part.split()) < 3:
+                sub_queries[-1] = f"{sub_queries[-1]} {part}"
+            else:
+                sub_queries.append(part)
+        
+        if len(sub_queries) <= 1:
+            return [query]
+        
+        max_sub_queries = max(2, self.config.max_sub_queries)
+        if len(sub_queries) > max_sub_queries:
+            overflow = "; ".join(sub_queries[max_sub_queries - 1:])
+            sub_queries = sub_queries[:max_sub_queries - 1] + [overflow]
+        
+        resolved = [sub_queries[0]]
+        for index, part in enumerate(sub_queries[1:], 1):
+            if not self._needs_subject(part):
+                resolved.append(part)
+                continue
+            
+            subject = self._topic_of(sub_queries[0])
+            for previous in reversed(sub_queries[:index]):
+                codes = [f"{dept} {num}" for dept, num in COURSE_CODE_PATTERN.findall(previous)]
+                if codes:
+                    subject = ", ".join(codes)
+                    break
+            resolved.append(f"{subject} {part}")
+        
+        return resolved
+    
+    @staticmethod
+    def _topic_of(clause: str) -> str:
+        """Extract the topic of a question ("What math courses do I need" -> "math courses")."""
+        match = re.match(
+            r"(?:what|which|how many)\s+(.+?)\s+(?:do|does|did|should|can|could|will|would|are|is)\b"
+            r"|(?:tell me about|what about|how about)\s+(.+)",
+            clause, flags=re.IGNORECASE
+        )
+        if match:
+            return (match.group(1) or match.group(2)).strip()
+        return clause
+    
+    @staticmethod
+    def _needs_subject(part: str) -> bool:
+        """Whether a sub-query is a bare follow-up that relies on an earlier subject."""
+        if COURSE_CODE_PATTERN.search(part):
+            return False
+        if re.match(r"(?:which|are|is|was|were|do|does|did|can|should)\b", part, flags=re.IGNORECASE):
+            return True
+        return re.search(r"\b(?:it|its|they|them|their|those|these|ones)\b", part, flags=re.IGNORECASE) is not None
+    
+    async def get_relevant_courses_multi(
+        self,
+        sub_queries: List[str],
+        k: Optional[int] = None,
+        filter_dict: Optional[Dict[str, Any]] = None
+    ) -> List[Document]:
+        """
+        Retrieve documents for several sub-queries concurrently and merge them.
+        
+        Each sub-query is embedded and searched in parallel. Results are
+        interleaved round-robin so every sub-query is represented, deduplicated
+        by course_id and capped at k documents. Earlier sub-queries win ties,
+        so the original query should come first.
+        
+        Args:
+            sub_queries: Sub-queries produced by decompose_query
+            k: Total number of documents to return (defaults to config.top_k)
+            filter_dict: Optional metadata filters for Pinecone
+            
+        Returns:
+            Merged list of relevant documents
+        """
+        k = k or self.config.top_k
+        per_query_k = self.config.sub_query_top_k or max(1, k // len(sub_queries))
+        
+        results = await asyncio.gather(*[
+            self.get_relevant_courses(sub_query, k=per_query_k, filter_dict=filter_dict)
+            for sub_query in sub_queries
+        ])
+        
+        merged = []
+        seen = set()
+        for rank in range(max((len(docs) for docs in results), default=0)):
+            for docs in results:
+                if rank >= len(docs):
+                    continue
+                doc = docs[rank]
+                key = doc.metadata.get('course_id') or doc.page_content
+                if key in seen:
+                    continue
+                seen.add(key)
+                merged.append(doc)
+        
+        logger.info(f"Merged {len(merged)} unique documents from {len(sub_queries)} sub-queries")
+        return merged[:k]
+    
     def format_context(self, documents: List[Document]) -> str:
         """
         Format retrieved documents into context for the LLM.
@@ -266,43 +561,138 @@ class PineconeRAG:
         
         return "\n\n" + "="*50 + "\n\n".join(context_parts)
     
-    async def generate_answer(
-        self, 
-        query: str, 
+    def extract_usage(self, response: Any) -> Dict[str, int]:
+        """
+        Extract token usage, including prompt-cache hits, from an LLM response.
+        
+        Args:
+            response: Message returned by the LLM
+            
+        Returns:
+            Dictionary with input, output, cached and cache-creation token counts
+        """
+        usage = getattr(response, "usage_metadata", None) or {}
+        details = usage.get("input_token_details") or {}
+        cached_tokens = details.get("cache_read", 0) or 0
+        
+        # Older langchain-openai versions only expose cached tokens in the raw usage
+        if not cached_tokens:
+            token_usage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+            cached_tokens = (token_usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0) or 0
+        
+        return {
+            "input_tokens": usage.get("input_tokens", 0),
+            "output_tokens": usage.get("output_tokens", 0),
+            "cached_tokens": cached_tokens,
+            "cache_creation_tokens": details.get("cache_creation", 0) or 0
+        }
+    
+    async def generate_answer_with_usage(
+        self,
+        query: str,
         context: str
-    ) -> str:
+    ) -> Tuple[str, Dict[str, int]]:
         """
-        Generate answer using LLM with the retrieved context.
+        Generate answer using LLM with the retrieved context, reporting token usage.
         
         Args:
             query: Original user question
             context: Formatted context from retrieved documents
             
         Returns:
-            Generated answer
+            Tuple of generated answer and token usage
         """
         try:
-            # Format prompt
-            messages = self.prompt_template.format_messages(
+            # Static system prefix followed by the per-request message
+            messages = [self.system_message] + self.prompt_template.format_messages(
                 context=context,
                 question=query
             )
             
             # Generate response
             response = await self.llm.ainvoke(messages)
+            usage = self.extract_usage(response)
             
-            logger.info(f"Answer generated: {len(response.content)} characters")
-            return response.content
+            logger.info(
+                f"Answer generated: {len(response.content)} characters, "
+                f"{usage['input_tokens']} input tokens ({usage['cached_tokens']} cached)"
+            )
+            return response.content, usage
             
         except Exception as e:
             logger.error(f"Failed to generate answer: {e}")
-            return f"Sorry, I encountered an error while generating the response: {str(e)}"
+            return f"Sorry, I encountered an error while generating the response: {str(e)}", {}
+    
+    async def generate_answer(
+        self, 
+        query: str, 
+        context: str
+    ) -> str:
+        """
+        Generate answer using LLM with the retrieved context.
+        
+        Args:
+            query: Original user question
+            context: Formatted context from retrieved documents
+            
+        Returns:
+            Generated answer
+        """
+        answer, _ = await self.generate_answer_with_usage(query, context)
+        return answer
+    
+    async def retrieve(
+        self,
+        user_query: str,
+        filters: Optional[Dict[str, Any]] = None,
+        top_k: Optional[int] = None,
+        student_profile: Optional[Dict[str, Any]] = None
+    ) -> List[Document]:
+        """
+        Retrieval stage of the pipeline: decomposition, search and profile ranking.
+        
+        Args:
+            user_query: User's question
+            filters: Optional Pinecone filters
+            top_k: Number of documents to retrieve
+            student_profile: Optional student profile used to skip completed courses
+            
+        Returns:
+            List of relevant documents
+        """
+        filters = self.build_student_filter(student_profile, filters)
+        
+        sub_queries = [user_query]
+        if self.config.enable_query_decomposition:
+            sub_queries = self.decompose_query(user_query)
+        
+        # The original query is always searched and ranks first in the merge;
+        # sub-queries that are just its prefix would repeat that search
+        searches = [user_query] + [q for q in sub_queries if not user_query.startswith(q)]
+        
+        if len(searches) > 1:
+            logger.info(f"Decomposed query into {len(sub_queries)} sub-queries, searching: {searches}")
+            documents = await self.get_relevant_courses_multi(
+                searches,
+                k=top_k,
+                filter_dict=filters
+            )
+        else:
+            documents = await self.get_relevant_courses(
+                user_query, 
+                k=top_k,
+                filter_dict=filters
+            )
+        
+        return self.apply_student_profile(documents, student_profile)
     
     async def query(
         self, 
         user_query: str,
         filters: Optional[Dict[str, Any]] = None,
-        top_k: Optional[int] = None
+        top_k: Optional[int] = None,
+        student_profile: Optional[Dict[str, Any]] = None,
+        documents: Optional[List[Document]] = None
     ) -> Dict[str, Any]:
         """
         Complete RAG pipeline: retrieve relevant documents and generate answer.
@@ -311,6 +701,10 @@ class PineconeRAG:
             user_query: User's question
             filters: Optional Pinecone filters
             top_k: Number of documents to retrieve
+            student_profile: Optional dict with completed_courses,
+                in_progress_courses and major
+            documents: Pre-retrieved documents (e.g. from a prefetch);
+                skips the retrieval step when provided
             
         Returns:
             Dictionary with answer, context, and metadata
@@ -321,25 +715,35 @@ class PineconeRAG:
             logger.info(f"Processing query: {user_query}")
             
             # Step 1: Retrieve relevant documents
-            documents = await self.get_relevant_courses(
-                user_query, 
-                k=top_k,
-                filter_dict=filters
-            )
+            if documents is None:
+                documents = await self.retrieve(
+                    user_query,
+                    filters=filters,
+                    top_k=top_k,
+                    student_profile=student_profile
+                )
+            else:
+                logger.info(f"Using {len(documents)} prefetched documents")
+            retrieval_time = (datetime.now() - start_time).total_seconds()
             
             if not documents:
                 return {
                     "answer": "I couldn't find relevant course information for your question. Please try rephrasing or asking about specific UCSD courses, degree requirements, or academic planning.",
                     "context": "",
                     "sources": [],
+                    "documents": [],
+                    "retrieval_time": retrieval_time,
                     "processing_time": (datetime.now() - start_time).total_seconds()
                 }
             
             # Step 2: Format context
             context = self.format_context(documents)
+            student_context = self.format_student_context(student_profile)
+            if student_context:
+                context = student_context + "\n" + context
             
             # Step 3: Generate answer
-            answer = await self.generate_answer(user_query, context)
+            answer, usage = await self.generate_answer_with_usage(user_query, context)
             
             # Step 4: Extract sources
             sources = []
@@ -358,6 +762,9 @@ class PineconeRAG:
                 "answer": answer,
                 "context": context,
                 "sources": sources,
+                "documents": documents,
+                "usage": usage,
+                "retrieval_time": retrieval_time,
                 "processing_time": processing_time
             }
             
@@ -367,6 +774,8 @@ class PineconeRAG:
                 "answer": f"Sorry, I encountered an error: {str(e)}",
                 "context": "",
                 "sources": [],
+                "documents": [],
+                "retrieval_time": 0,
                 "processing_time": (datetime.now() - start_time).total_seconds()
             }
 
@@ -375,7 +784,8 @@ def create_rag_system(
     pinecone_api_key: str,
     pinecone_index_name: str,
     llm_provider: str = "openai",
-    llm_model: str = "gpt-4o-mini-2024-07-18"
+    llm_model: str = "gpt-4o-mini-2024-07-18",
+    enable_query_decomposition: bool = False
 ) -> PineconeRAG:
     """
     Factory function to create a RAG system with common configurations.
@@ -385,6 +795,7 @@ def create_rag_system(
         pinecone_index_name: Name of the Pinecone index
         llm_provider: "openai" or "anthropic"
         llm_model: Model name
+        enable_query_decomposition: Split compound questions into parallel sub-queries
         
     Returns:
         Configured PineconeRAG instance
@@ -393,7 +804,8 @@ def create_rag_system(
         pinecone_api_key=pinecone_api_key,
         pinecone_index_name=pinecone_index_name,
         llm_provider=llm_provider,
-        llm_model=llm_model
+        llm_model=llm_model,
+        enable_query_decomposition=enable_query_decomposition
     )
     
     return PineconeRAG(config)
@@ -414,6 +826,7 @@ async def test_rag_system():
         "What are the prerequisites for DSC 100?",
         "Tell me about machine learning courses",
         "What math courses do I need for data science?",
+        "What math courses do I need for data science, and which are offered in Fall?",
         "How many credits is DSC 30?",
         "What courses should I take in my first year?"
     ]
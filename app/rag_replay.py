@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Replay harness for the UCSD Course Advisory RAG pipeline
+========================================================
+
+Records production queries (query, retrieved documents, answer, timings) to a
+JSONL file and replays them offline against alternative RAGConfig settings,
+reporting recall@k, context token counts and latency distributions.
+
+Recording is enabled in the API by setting RAG_RECORD_PATH.
+
+Usage:
+    python rag_replay.py --records records.jsonl --labels labels.jsonl \\
+        --config '{"top_k": 5}' --mode recorded
+
+Labels file: one JSON object per line, {"query": "...", "relevant": ["DSC 100", ...]}
+
+Modes:
+    recorded  Retrieval and generation are served from the recording
+              (deterministic, no API calls). Only settings that act on the
+              retrieved documents, such as top_k, change the outcome, and
+              top_k cannot exceed the value used when recording.
+    live      Retrieval runs against Pinecone with the given config; the
+              answer is still served from the recording unless --generate
+              is passed.
+
+Note: RAGConfig.similarity_threshold is not read by the pipeline yet, so
+overriding it has no effect on either mode; the harness warns if it is set.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import threading
+from dataclasses import asdict
+from typing import List, Dict, Any, Optional
+
+from langchain.schema import Document
+
+from rag_pipeline import RAGConfig, PineconeRAG, normalize_course_id
+
+
+class QueryRecorder:
+    """Append pipeline results to a JSONL file for later replay."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        query: str,
+        result: Dict[str, Any],
+        student_profile: Optional[Dict[str, Any]] = None
+    ):
+        """Write a single query and its pipeline result as one JSON line."""
+        entry = {
+            "timestamp": time.time(),
+            "query": query,
+            "student_profile": student_profile,
+            "documents": [
+                {"page_content": doc.page_content, "metadata": doc.metadata}
+                for doc in result.get("documents", [])
+            ],
+            "answer": result.get("answer", ""),
+            "usage": result.get("usage", {}),
+            "retrieval_time": result.get("retrieval_time", 0),
+            "processing_time": result.get("processing_time", 0)
+        }
+        line = json.dumps(entry, default=str)
+
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+def load_jsonl(path: str) -> List[Dict[str, Any]]:
+    """Load a JSONL file, skipping blank lines."""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class RecordedVectorStore:
+    """
+    Vector store stand-in that serves documents from a recording.
+
+    Lookups are exact. Sub-queries produced by decomposition were never
+    recorded, so they are served the documents of parent_query, the recorded
+    query currently being replayed.
+    """
+
+    def __init__(self, records: List[Dict[str, Any]]):
+        self.documents = {
+            record["query"]: [Document(**doc) for doc in record["documents"]]
+            for record in records
+        }
+        self.parent_query = None
+
+    async def asimilarity_search(self, query: str, k: int = 4, filter=None, **kwargs) -> List[Document]:
+        if query in self.documents:
+            return self.documents[query][:k]
+        if self.parent_query is not None:
+            return self.documents.get(self.parent_query, [])[:k]
+        return []
+
+
+class RecordedMessage:
+    def __init__(self, content: str):
+        self.content = content
+        self.response_metadata = {}
+        self.usage_metadata = None
+
+
+class RecordedLLM:
+    """LLM stand-in that returns the recorded answer for each question."""
+
+    def __init__(self, records: List[Dict[str, Any]]):
+        self.answers = {record["query"]: record["answer"] for record in records}
+
+    async def ainvoke(self, messages, **kwargs) -> RecordedMessage:
+        # The human message ends with "Student Question: {question}"
+        content = messages[-1].content if messages else ""
+        marker = "Student Question: "
+        if marker not in content:
+            return RecordedMessage("")
+        question = content.rsplit(marker, 1)[1]
+        return RecordedMessage(self.answers.get(question, ""))
+
+
+def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    """Count tokens with tiktoken when available, else estimate ~4 chars/token."""
+    try:
+        import tiktoken
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+        return len(encoding.encode(text))
+    except ImportError:
+        return len(text) // 4
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of a list of values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def latency_summary(values: List[float]) -> Dict[str, float]:
+    """p50/p90/p99 of a list of latencies in seconds."""
+    return {name: percentile(values, pct) for name, pct in (("p50", 50), ("p90", 90), ("p99", 99))}
+
+
+def recall_at_k(documents: List[Document], relevant: List[str], k: int) -> float:
+    """Fraction of labeled relevant courses present in the top-k documents."""
+    if not relevant:
+        return 0.0
+    retrieved = {normalize_course_id(doc.metadata.get('course_id', '')) for doc in documents[:k]}
+    expected = {normalize_course_id(course_id) for course_id in relevant}
+    return len(retrieved & expected) / len(expected)
+
+
+async def replay(
+    records: List[Dict[str, Any]],
+    config: RAGConfig,
+    labels: Optional[Dict[str, List[str]]] = None,
+    mode: str = "recorded",
+    generate: bool = False
+) -> Dict[str, Any]:
+    """
+    Replay recorded queries against a configuration and collect metrics.
+
+    Args:
+        records: Recorded queries from QueryRecorder
+        config: Configuration to evaluate
+        labels: Optional mapping of query -> relevant course ids
+        mode: "recorded" or "live" retrieval
+        generate: Call the configured LLM instead of the recorded answer
+
+    Returns:
+        Report with per-query results and aggregate metrics
+    """
+    vector_store = RecordedVectorStore(records) if mode == "recorded" else None
+    llm = None if generate else RecordedLLM(records)
+
+    rag = PineconeRAG(config, vector_store=vector_store, llm=llm)
+
+    results = []
+    for record in records:
+        query = record["query"]
+        if vector_store is not None:
+            vector_store.parent_query = query
+        result = await rag.query(query, student_profile=record.get("student_profile"))
+
+        entry = {
+            "query": query,
+            "retrieved": [doc.metadata.get('course_id', 'Unknown') for doc in result["documents"]],
+            "context_tokens": count_tokens(result["context"]),
+            "retrieval_time": result["retrieval_time"],
+            "processing_time": result["processing_time"],
+            "recorded_retrieval_time": record.get("retrieval_time", 0),
+            "recorded_processing_time": record.get("processing_time", 0)
+        }
+        if labels and query in labels:
+            entry["recall_at_k"] = recall_at_k(result["documents"], labels[query], config.top_k)
+        results.append(entry)
+
+    recalls = [r["recall_at_k"] for r in results if "recall_at_k" in r]
+    tokens = [r["context_tokens"] for r in results]
+    retrieval_times = [r["retrieval_time"] for r in results]
+    processing_times = [r["processing_time"] for r in results]
+
+    return {
+        "config": {k: v for k, v in asdict(config).items() if k not in ("pinecone_api_key", "system_prompt", "question_prompt")},
+        "mode": mode,
+        "queries": len(results),
+        "labeled_queries": len(recalls),
+        "mean_recall_at_k": sum(recalls) / len(recalls) if recalls else None,
+        "mean_context_tokens": sum(tokens) / len(tokens) if tokens else 0,
+        "retrieval_latency": latency_summary(retrieval_times),
+        "total_latency": latency_summary(processing_times),
+        # Production baseline captured when the queries were recorded
+        "recorded_retrieval_latency": latency_summary([r["recorded_retrieval_time"] for r in results]),
+        "recorded_total_latency": latency_summary([r["recorded_processing_time"] for r in results]),
+        "results": results
+    }
+
+
+def print_report(report: Dict[str, Any]):
+    """Print a human-readable summary of a replay report."""
+    print(f"Mode: {report['mode']}  Queries: {report['queries']}  Labeled: {report['labeled_queries']}")
+    print(f"Config: {json.dumps(report['config'])}")
+    if report["mean_recall_at_k"] is not None:
+        print(f"Mean recall@{report['config']['top_k']}: {report['mean_recall_at_k']:.3f}")
+    print(f"Mean context tokens: {report['mean_context_tokens']:.0f}")
+    if report["mode"] == "recorded":
+        print("Note: replayed latencies exclude backend calls in recorded mode; compare against the recorded baseline")
+    for name in ("retrieval_latency", "total_latency"):
+        for label, latency in (("replayed", report[name]), ("recorded", report[f"recorded_{name}"])):
+            print(f"{name} ({label}): p50={latency['p50']*1000:.1f}ms p90={latency['p90']*1000:.1f}ms p99={latency['p99']*1000:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded RAG queries against a configuration")
+    parser.add_argument("--records", required=True, help="JSONL file written by QueryRecorder")
+    parser.add_argument("--labels", help="JSONL file of {query, relevant} labels")
+    parser.add_argument("--config", default="{}", help="JSON object of RAGConfig overrides")
+    parser.add_argument("--mode", choices=["recorded", "live"], default="recorded")
+    parser.add_argument("--generate", action="store_true", help="Call the configured LLM instead of the recorded answer")
+    parser.add_argument("--output", help="Write the full JSON report to this path")
+    args = parser.parse_args()
+
+    records = load_jsonl(args.records)
+    labels = None
+    if args.labels:
+        labels = {label["query"]: label["relevant"] for label in load_jsonl(args.labels)}
+
+    overrides = json.loads(args.config)
+    if "similarity_threshold" in overrides:
+        print("Warning: similarity_threshold is not applied by the pipeline; results will not change")
+
+    # Environment defaults, with --config taking precedence
+    settings = {
+        "pinecone_api_key": os.getenv("PINECONE_API_KEY", ""),
+        "pinecone_index_name": os.getenv("PINECONE_INDEX_NAME", "openaicourses"),
+        "llm_provider": os.getenv("LLM_PROVIDER", "openai"),
+        "llm_model": os.getenv("LLM_MODEL", "gpt-4o-mini-2024-07-18")
+    }
+    settings.update(overrides)
+    config = RAGConfig(**settings)
+
+    report = asyncio.run(replay(records, config, labels=labels, mode=args.mode, generate=args.generate))
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,4 @@
-import React, { useState, useRef, useEffect } from "react";
+import React, { useState, useRef, useEffect, useMemo } from "react";
 import CourseSearch from "./CourseSearch";
 import CourseAssistant from "./CourseAssistant";
 import CourseDetails from "./CourseDetails";
@@ -18,6 +18,10 @@ const RightSidebar = () => {
   const [rightSidebarWidth, setRightSidebarWidth] = useState(300);
   const [isResizing, setIsResizing] = useState(false);
   const chatEndRef = useRef(null);
+  // Per-session thread id so server-side prefetches and profiles are not shared between students
+  const threadIdRef = useRef(
+    window.crypto?.randomUUID?.() || `thread-${Date.now()}-${Math.random().toString(36).slice(2)}`
+  );
 
   const handleSearch = async (query) => {
     if (!query.trim()) {
@@ -54,6 +58,29 @@ const RightSidebar = () => {
   };
   const debouncedSearch = debounce(handleSearch, 500);
 
+  // Speculatively run retrieval while the user types; best-effort, errors ignored
+  const debouncedPrefetch = useMemo(
+    () =>
+      debounce((message) => {
+        fetch(`${EXPRESS_URL}/chat/prefetch`, {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify({ message, thread_id: threadIdRef.current }),
+        }).catch(() => {});
+      }, 400),
+    []
+  );
+
+  useEffect(() => {
+    if (currentMessage.trim()) {
+      debouncedPrefetch(currentMessage);
+    } else {
+      debouncedPrefetch.cancel();
+    }
+  }, [currentMessage, debouncedPrefetch]);
+
+  useEffect(() => () => debouncedPrefetch.cancel(), [debouncedPrefetch]);
+
   useEffect(() => {
     if (chatEndRef.current) {
       chatEndRef.current.scrollIntoView({ behavior: "smooth" });
@@ -70,6 +97,7 @@ const RightSidebar = () => {
   const sendMessage = async () => {
     if (!currentMessage.trim()) return;
 
+    debouncedPrefetch.cancel();
     const userMessage = { role: "user", content: currentMessage };
     setChatMessages((prev) => [...prev, userMessage]);
     setCurrentMessage("");
@@ -81,7 +109,7 @@ const RightSidebar = () => {
         headers: { "Content-Type": "application/json" },
         body: JSON.stringify({
           message: currentMessage,
-          thread_id: "default-thread",
+          thread_id: threadIdRef.current,
         }),
       });
 
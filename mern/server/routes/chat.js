@@ -69,4 +69,27 @@ router.post("/", async (req, res) => {
   }
 });
 
+// Proxy endpoint for speculative retrieval while the user types
+router.post("/prefetch", async (req, res) => {
+  try {
+    const FASTAPI_URL = process.env.FASTAPI_URL || 
+                       process.env.REACT_APP_FASTAPI_URL || 
+                       'https://academic-planner-app.onrender.com';
+    
+    const response = await fetch(`${FASTAPI_URL}/chat/prefetch`, {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+      },
+      body: JSON.stringify(req.body),
+      signal: AbortSignal.timeout(5000) // prefetch is best-effort
+    });
+
+    res.status(response.status).json(await response.json());
+  } catch (error) {
+    // Prefetch failures are harmless; the final /chat request retrieves normally
+    res.json({ status: "skipped" });
+  }
+});
+
 export default router;